@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+"""
+Run the test suite against the models in the ``tests`` app.
+"""
+import os
+import sys
+
+import django
+from django.conf import settings
+from django.test.utils import get_runner
+
+
+if __name__ == '__main__':
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'tests.settings'
+    django.setup()
+    TestRunner = get_runner(settings)
+    failures = TestRunner().run_tests(['tests'])
+    sys.exit(bool(failures))
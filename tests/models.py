@@ -0,0 +1,27 @@
+from django.db import models
+
+
+class Publisher(models.Model):
+    name = models.CharField(max_length=50)
+    code = models.CharField(max_length=10, unique=True, null=True)
+
+
+class Tag(models.Model):
+    name = models.CharField(max_length=50)
+
+
+class Book(models.Model):
+    title = models.CharField(max_length=50)
+    publisher = models.ForeignKey(Publisher, null=True,
+        on_delete=models.CASCADE)
+    imprint = models.ForeignKey(Publisher, to_field='code', null=True,
+        related_name='imprints', on_delete=models.CASCADE)
+    tags = models.ManyToManyField(Tag)
+
+    def shout(self):
+        return self.title.upper()
+
+
+class Chapter(models.Model):
+    title = models.CharField(max_length=50)
+    book = models.ForeignKey(Book, on_delete=models.CASCADE)
@@ -0,0 +1,12 @@
+SECRET_KEY = 'wadofstuff-tests'
+
+INSTALLED_APPS = (
+    'tests',
+)
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    },
+}
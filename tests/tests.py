@@ -0,0 +1,292 @@
+from io import StringIO
+
+from django.test import TestCase
+
+from wadofstuff.django.serializers import wad_of_json
+from wadofstuff.django.serializers.python import Serializer
+
+from .models import Book, Chapter, Publisher, Tag
+
+
+class PrefetchTestCase(TestCase):
+    """
+    Followed relations that are prefetched are served from the prefetch
+    cache instead of being queried again for every object.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        tag = Tag.objects.create(name='tag')
+        for i in range(3):
+            book = Book.objects.create(title='book %d' % i)
+            book.tags.add(tag)
+            for j in range(2):
+                Chapter.objects.create(title='chapter %d' % j, book=book)
+
+    def serialize(self, queryset, **options):
+        return Serializer().serialize(queryset, **options)
+
+    def test_prefetched_reverse_fk(self):
+        expected = self.serialize(Book.objects.all(), fields=['title'],
+            relations=['chapter_set'])
+        with self.assertNumQueries(2):
+            result = self.serialize(
+                Book.objects.prefetch_related('chapter_set'),
+                fields=['title'], relations=['chapter_set'])
+        self.assertEqual(result, expected)
+
+    def test_prefetched_reverse_m2m(self):
+        expected = self.serialize(Tag.objects.all(),
+            relations={'book_set': {'fields': ['title']}})
+        with self.assertNumQueries(2):
+            result = self.serialize(Tag.objects.prefetch_related('book_set'),
+                relations={'book_set': {'fields': ['title']}})
+        self.assertEqual(result, expected)
+
+    def test_auto_prefetch_list(self):
+        books = list(Book.objects.all())
+        expected = self.serialize(books, fields=['title', 'tags'],
+            relations=['chapter_set', 'tags'])
+        books = list(Book.objects.all())
+        # one query per followed relation for the whole list
+        with self.assertNumQueries(2):
+            result = self.serialize(books, fields=['title', 'tags'],
+                relations=['chapter_set', 'tags'], auto_prefetch=True)
+        self.assertEqual(result, expected)
+
+    def test_auto_prefetch_list_reverse_m2m(self):
+        tags = list(Tag.objects.all())
+        expected = self.serialize(tags,
+            relations={'book_set': {'fields': ['title']}})
+        tags = list(Tag.objects.all())
+        with self.assertNumQueries(1):
+            result = self.serialize(tags,
+                relations={'book_set': {'fields': ['title']}},
+                auto_prefetch=True)
+        self.assertEqual(result, expected)
+
+    def test_auto_prefetch_reverse_fk(self):
+        expected = self.serialize(Book.objects.all(), fields=['title'],
+            relations=['chapter_set'])
+        with self.assertNumQueries(2):
+            result = self.serialize(Book.objects.all(), fields=['title'],
+                relations=['chapter_set'], auto_prefetch=True)
+        self.assertEqual(result, expected)
+
+    def test_auto_prefetch_reverse_m2m(self):
+        expected = self.serialize(Tag.objects.all(),
+            relations={'book_set': {'fields': ['title']}})
+        with self.assertNumQueries(2):
+            result = self.serialize(Tag.objects.all(),
+                relations={'book_set': {'fields': ['title']}},
+                auto_prefetch=True)
+        self.assertEqual(result, expected)
+
+    def test_auto_prefetch_nested(self):
+        relations = {'book': {'fields': ['title', 'tags'],
+            'relations': ('tags',)}}
+        expected = self.serialize(Chapter.objects.all(),
+            relations=relations)
+        # chapters with their books selected, plus the books' tags
+        with self.assertNumQueries(2):
+            result = self.serialize(Chapter.objects.all(),
+                relations=relations, auto_prefetch=True)
+        self.assertEqual(result, expected)
+
+    def test_auto_prefetch_leaves_optimized_queryset(self):
+        queryset = Book.objects.prefetch_related('tags')
+        self.assertIs(
+            Serializer().prefetch_queryset(queryset), queryset)
+
+
+class HookTestCase(TestCase):
+    """
+    Subclasses can override the handler hooks with their usual signatures.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        Book.objects.create(title='book')
+
+    def test_handle_field_override(self):
+        class UpperSerializer(Serializer):
+            def handle_field(self, obj, field):
+                super(UpperSerializer, self).handle_field(obj, field)
+                self._fields[field.name] = self._fields[field.name].upper()
+
+        result = UpperSerializer().serialize(Book.objects.all(),
+            fields=['title'])
+        self.assertEqual(result[0]['fields'], {'title': 'BOOK'})
+        result = Serializer().serialize(Book.objects.all(), fields=['title'])
+        self.assertEqual(result[0]['fields'], {'title': 'book'})
+
+    def test_handle_extra_field_override(self):
+        class ExtraSerializer(Serializer):
+            def handle_extra_field(self, obj, field):
+                self._extras[field] = 'extra %s' % field
+
+        result = ExtraSerializer().serialize(Book.objects.all(),
+            fields=['title'], extras=['__str__'])
+        self.assertEqual(result[0]['extras'], {'__str__': 'extra __str__'})
+        result = Serializer().serialize(Book.objects.all(),
+            fields=['title'], extras=['__str__'])
+        self.assertEqual(result[0]['extras'], {'__str__': 'Book object'})
+
+    def test_extra_method(self):
+        result = Serializer().serialize(Book.objects.all(),
+            fields=['title'], extras=['shout'])
+        self.assertEqual(result[0]['extras'], {'shout': 'BOOK'})
+
+    def test_extra_method_shadowed_on_instance(self):
+        # e.g. an annotation or cached value named like a model method
+        book = Book.objects.get()
+        book.shout = 5
+        result = Serializer().serialize([book], fields=['title'],
+            extras=['shout'])
+        self.assertEqual(result[0]['extras'], {'shout': 5})
+
+
+class SerializeObjectTestCase(TestCase):
+    """
+    serialize_object() returns the entry for a single instance.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        book = Book.objects.create(title='book')
+        Chapter.objects.create(title='chapter', book=book)
+
+    def test_python(self):
+        book = Book.objects.get()
+        expected = Serializer().serialize([book], relations=['chapter_set'])
+        result = Serializer().serialize_object(book,
+            relations=['chapter_set'])
+        self.assertEqual(result, expected[0])
+
+    def test_json(self):
+        book = Book.objects.get()
+        stream = StringIO()
+        result = wad_of_json.Serializer().serialize_object(book,
+            stream=stream)
+        self.assertEqual(result, Serializer().serialize([book])[0])
+        self.assertEqual(stream.getvalue(), '')
+
+    def test_auto_prefetch(self):
+        book = Book.objects.get()
+        expected = Serializer().serialize_object(book, fields=['title'],
+            relations=['chapter_set'])
+        book = Book.objects.get()
+        Serializer().serialize_object(book, fields=['title'],
+            relations=['chapter_set'], auto_prefetch=True)
+        # chapters now come from the prefetch cache
+        with self.assertNumQueries(0):
+            result = Serializer().serialize_object(book, fields=['title'],
+                relations=['chapter_set'])
+        self.assertEqual(result, expected)
+
+
+class ForeignKeyTestCase(TestCase):
+    """
+    Foreign keys that aren't followed serialize to the related key value.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.publisher = Publisher.objects.create(name='publisher', code='pub')
+        Book.objects.create(title='book 0', publisher=cls.publisher,
+            imprint=cls.publisher)
+        Book.objects.create(title='book 1')
+
+    def serialize(self, **options):
+        return [entry['fields'] for entry in
+            Serializer().serialize(Book.objects.order_by('pk'), **options)]
+
+    def test_pk_only(self):
+        # the key is read from the row, the publishers are never fetched
+        with self.assertNumQueries(1):
+            result = self.serialize(fields=['publisher'])
+        self.assertEqual(result, [
+            {'publisher': self.publisher.pk},
+            {'publisher': None},
+        ])
+
+    def test_to_field(self):
+        result = self.serialize(fields=['imprint'])
+        self.assertEqual(result, [{'imprint': 'pub'}, {'imprint': None}])
+
+    def test_followed(self):
+        result = self.serialize(fields=['publisher'],
+            relations={'publisher': {'fields': ['name']}})
+        self.assertEqual(result[0]['publisher']['fields'],
+            {'name': 'publisher'})
+        self.assertEqual(result[1], {'publisher': None})
+
+
+class ManyToManyTestCase(TestCase):
+    """
+    Many-to-many fields that aren't followed serialize to lists of keys.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.tags = [Tag.objects.create(name='tag %d' % i) for i in range(2)]
+        Book.objects.create(title='book 0').tags.add(*cls.tags)
+        Book.objects.create(title='book 1')
+
+    def serialize(self, queryset):
+        # related rows have no defined order
+        return [{'tags': sorted(entry['fields']['tags'])} for entry in
+            Serializer().serialize(queryset, fields=['tags'])]
+
+    def test_pk_only(self):
+        expected = [{'tags': [tag.pk for tag in self.tags]}, {'tags': []}]
+        # one query for the books and one keys-only query per book
+        with self.assertNumQueries(3):
+            result = self.serialize(Book.objects.order_by('pk'))
+        self.assertEqual(result, expected)
+
+    def test_pk_only_prefetched(self):
+        expected = [{'tags': [tag.pk for tag in self.tags]}, {'tags': []}]
+        with self.assertNumQueries(2):
+            result = self.serialize(
+                Book.objects.order_by('pk').prefetch_related('tags'))
+        self.assertEqual(result, expected)
+
+
+class UseIteratorTestCase(TestCase):
+    """
+    use_iterator streams a QuerySet without filling its result cache.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(3):
+            Book.objects.create(title='book %d' % i)
+
+    def test_use_iterator(self):
+        expected = Serializer().serialize(Book.objects.order_by('pk'))
+        queryset = Book.objects.order_by('pk')
+        serializer = Serializer()
+        result = serializer.serialize(queryset, use_iterator=True)
+        self.assertEqual(result, expected)
+        self.assertIsNone(queryset._result_cache)
+        # the length is unknown, so entries were appended
+        self.assertIsNone(serializer._n)
+        self.assertIsNone(serializer._i)
+
+
+class EmptyQuerySetTestCase(TestCase):
+    """
+    Querysets known to be empty are serialized without a query.
+    """
+
+    def test_python(self):
+        with self.assertNumQueries(0):
+            result = Serializer().serialize(Book.objects.none(),
+                auto_prefetch=True)
+        self.assertEqual(result, [])
+
+    def test_json(self):
+        with self.assertNumQueries(0):
+            result = wad_of_json.Serializer().serialize(Book.objects.none())
+        self.assertEqual(result, '[]')
@@ -4,9 +4,301 @@ New base serializer class to handle full serialization of model objects.
 Applied patch from http://code.google.com/p/wadofstuff/issues/detail?id=4
 by stur...@gmail.com, Apr 7, 2009.
 """
+from collections import Counter, namedtuple
+from functools import lru_cache
 from io import StringIO
+from types import FunctionType
 
 from django.core.serializers import base
+from django.db import models
+from django.db.models.options import Options
+from django.db.models.query import QuerySet
+from django.utils.encoding import is_protected_type
+
+try:
+    from django.db.models import prefetch_related_objects
+except ImportError:
+    # Django < 1.10 takes the lookups as a single list
+    from django.db.models.query import prefetch_related_objects as \
+        _prefetch_related_objects
+
+    def prefetch_related_objects(model_instances, *related_lookups):
+        _prefetch_related_objects(model_instances, related_lookups)
+
+
+# Upper bound on the size of each plan cache below. fields, excludes and
+# extras may come from request data, so the caches must not grow forever.
+_CACHE_SIZE = 1024
+
+# Stock field classes whose values are always protected types (None, numbers,
+# dates and Decimals) and can be passed through without is_protected_type().
+_PROTECTED_FIELD_TYPES = frozenset(
+    getattr(models, name) for name in (
+        'AutoField', 'BigAutoField', 'BigIntegerField', 'BooleanField',
+        'DateField', 'DateTimeField', 'DecimalField', 'FloatField',
+        'IntegerField', 'NullBooleanField', 'PositiveIntegerField',
+        'PositiveSmallIntegerField', 'SmallIntegerField', 'TimeField',
+    ) if hasattr(models, name)
+)
+
+# get_all_related_objects() and friends gave way to get_fields() in Django
+# 1.8 and were removed in 1.10; pick the Options API once at import time.
+_USE_NEW_META = not hasattr(Options, 'get_all_related_objects')
+
+_Plan = namedtuple('_Plan', (
+    'local_fields',
+    'm2m_fields',
+    'related_fk_accessors',
+    'related_m2m_accessors',
+))
+
+
+def _related_objects(opts):
+    """Return the reverse fk and reverse m2m relation objects of ``opts``."""
+    # relations patch
+    if _USE_NEW_META:
+        related_fk_objects = [
+            f for f in opts.get_fields()
+            if (f.one_to_many or f.one_to_one) and
+            f.auto_created and
+            not f.concrete
+        ]
+        related_m2m_objects = [
+            f for f in opts.get_fields(include_hidden=True)
+            if f.many_to_many and f.auto_created
+        ]
+    else:
+        related_fk_objects = opts.get_all_related_objects()
+        related_m2m_objects = opts.get_all_related_many_to_many_objects()
+    # end relations patch
+    return related_fk_objects, related_m2m_objects
+
+
+@lru_cache(maxsize=_CACHE_SIZE)
+def _related_models(model):
+    """Map the forward and reverse relation names of ``model`` to the models
+    they lead to.
+    """
+    opts = model._meta
+    related_models = {}
+    for field in opts.local_fields:
+        if field.rel is not None:
+            related_models[field.name] = field.rel.to
+    for field in opts.many_to_many:
+        related_models[field.name] = field.rel.to
+    related_fk_objects, related_m2m_objects = _related_objects(opts)
+    for ro in related_fk_objects + related_m2m_objects:
+        related_models[ro.get_accessor_name()] = (
+            getattr(ro, 'related_model', None) or ro.model)
+    return related_models
+
+
+@lru_cache(maxsize=_CACHE_SIZE)
+def _field_writer(field):
+    """Return a callable that reads the serialized value of ``field`` from an
+    object.
+    """
+    if type(field) in _PROTECTED_FIELD_TYPES:
+        return field._get_val_from_obj
+
+    def writer(obj, _is_protected=is_protected_type):
+        value = field._get_val_from_obj(obj)
+        # Protected types (i.e., primitives like None, numbers, dates,
+        # and Decimals) are passed through as is. All other values are
+        # converted to string first.
+        if _is_protected(value):
+            return value
+        return field.value_to_string(obj)
+    return writer
+
+
+@lru_cache(maxsize=_CACHE_SIZE)
+def _build_plan(model, fields, excludes):
+    """Return the serialization plan for ``model``.
+
+    ``fields`` and ``excludes`` are frozensets of field names. The plan holds
+    the fields that survive filtering as ``(field, attname, name, is_fk,
+    writer)`` tuples in model order, plus the accessor names of reverse
+    relations.
+    ``name`` is the name matched against ``fields`` and ``excludes``; for
+    foreign keys that is the attname with its ``_id`` suffix sliced off.
+    ``writer`` is the ``_field_writer()`` of non-relational fields.
+    Every object of a queryset shares the same model, so this only has to be
+    worked out once instead of once per object.
+    """
+    opts = model._meta
+    local_fields = []
+    for field in opts.local_fields:
+        if not field.serialize:
+            continue
+        attname = field.attname
+        is_fk = field.rel is not None
+        if is_fk:
+            name = attname[:-3]
+            writer = None
+        else:
+            name = attname
+            writer = _field_writer(field)
+        if name not in excludes and (not fields or name in fields):
+            local_fields.append((field, attname, name, is_fk, writer))
+
+    m2m_fields = []
+    for field in opts.many_to_many:
+        if not field.serialize:
+            continue
+        attname = field.attname
+        if attname not in excludes and (not fields or attname in fields):
+            m2m_fields.append((field, attname))
+
+    related_fk_objects, related_m2m_objects = _related_objects(opts)
+    related_fk_accessors = [ro.get_accessor_name() for ro in related_fk_objects]
+    related_m2m_accessors = [
+        ro.get_accessor_name() for ro in related_m2m_objects]
+
+    return _Plan(
+        tuple(local_fields),
+        tuple(m2m_fields),
+        tuple(n for n in related_fk_accessors if n not in excludes),
+        tuple(n for n in related_m2m_accessors if n not in excludes),
+    )
+
+
+@lru_cache(maxsize=_CACHE_SIZE)
+def _build_extras_plan(model, extras):
+    """Map each of the ``extras`` of ``model`` to ``on_class``.
+
+    ``on_class`` is True for plain methods defined on the model class, which
+    every instance has, so they can be read without probing for them. The
+    value is still checked with ``callable()`` per object, since an instance
+    attribute such as an annotation may shadow the method. Anything else
+    (properties, instance attributes, annotations) is probed per object.
+    """
+    return dict(
+        (name, isinstance(getattr(model, name, None), FunctionType))
+        for name in extras)
+
+
+@lru_cache(maxsize=_CACHE_SIZE)
+def _uses_private_handler(cls, name):
+    """Return True if hook ``name`` of ``cls`` is the one defined alongside
+    its private ``_<name>`` fast path, i.e. no subclass overrides it.
+    """
+    private = '_' + name
+    for klass in cls.__mro__:
+        if private in klass.__dict__:
+            return klass.__dict__.get(name) is getattr(cls, name)
+    return False
+
+
+@lru_cache(maxsize=_CACHE_SIZE)
+def _compile_per_object(plan, direct_fields=False):
+    """Return a function ``run(serializer, obj)`` that serializes ``obj``
+    according to ``plan``.
+
+    With ``direct_fields`` the generated code passes each field's writer to
+    the serializer's private ``_handle_field(obj, field, writer)`` instead
+    of calling the ``handle_field(obj, field)`` hook.
+
+    The function is generated as straight-line code that calls the handlers
+    for exactly the fields in the plan, with the field objects and writers
+    bound as default arguments, so serializing an object involves no loops
+    over the plan and no branching on field kinds.
+    """
+    namespace = {}
+    params = ['s', 'o']
+    body = ['s.start_object(o)']
+    calls = []
+    for i, (field, attname, name, is_fk, writer) in enumerate(
+            plan.local_fields):
+        namespace['F%d' % i] = field
+        params.append('F%d=F%d' % (i, i))
+        if is_fk:
+            calls.append(('handle_fk_field', 'o, F%d' % i))
+        else:
+            if direct_fields:
+                namespace['W%d' % i] = writer
+                params.append('W%d=W%d' % (i, i))
+                calls.append(('_handle_field', 'o, F%d, W%d' % (i, i)))
+            else:
+                calls.append(('handle_field', 'o, F%d' % i))
+    for i, (field, attname) in enumerate(plan.m2m_fields):
+        namespace['M%d' % i] = field
+        params.append('M%d=M%d' % (i, i))
+        calls.append(('handle_m2m_field', 'o, M%d' % i))
+    for field_name in plan.related_fk_accessors:
+        calls.append(('handle_related_fk_field', 'o, %r' % field_name))
+    for field_name in plan.related_m2m_accessors:
+        calls.append(('handle_related_m2m_field', 'o, %r' % field_name))
+
+    # handlers called more than once are looked up once per object
+    counts = Counter(handler for handler, args in calls)
+    for handler in sorted(counts):
+        if counts[handler] > 1:
+            body.append('%s = s.%s' % (handler, handler))
+    for handler, args in calls:
+        if counts[handler] == 1:
+            handler = 's.' + handler
+        body.append('%s(%s)' % (handler, args))
+    body.extend([
+        'for extra in s.extras:',
+        '    s.handle_extra_field(o, extra)',
+        's.end_object(o)',
+    ])
+    source = 'def run(%s):\n%s\n' % (
+        ', '.join(params), '\n'.join('    ' + line for line in body))
+    exec(compile(source, '<serializer plan>', 'exec'), namespace)
+    return namespace['run']
+
+
+def _relation_options(relations):
+    """Map each name in the ``relations`` option to the serialization options
+    for that relation.
+    """
+    if isinstance(relations, dict):
+        return dict(
+            (name, options if isinstance(options, dict) else {})
+            for name, options in relations.items())
+    return dict((name, {}) for name in relations)
+
+
+def _prefetch_lookups(model, fields, excludes, relations, prefix=''):
+    """Return the ``(select_related, prefetch_related)`` lookups needed to
+    serialize ``relations`` of ``model``.
+
+    Nested ``relations`` options are followed to build dotted lookups such as
+    ``author__publisher``. A lookup can only be select_related if every step
+    of it is a forward foreign key; everything else is prefetched.
+    """
+    plan = _build_plan(model, fields, excludes)
+    fk_names = set(name
+        for field, attname, name, is_fk, writer in plan.local_fields if is_fk)
+    names = fk_names.union(
+        (attname for field, attname in plan.m2m_fields),
+        plan.related_fk_accessors,
+        plan.related_m2m_accessors,
+    )
+    related_models = _related_models(model)
+    select_related = []
+    prefetch_related = []
+    for name, options in _relation_options(relations).items():
+        if name not in names:
+            continue
+        lookup = prefix + name
+        nested_select, nested_prefetch = _prefetch_lookups(
+            related_models[name],
+            frozenset(options.get('fields', [])),
+            frozenset(options.get('excludes', [])),
+            options.get('relations', []),
+            lookup + '__',
+        )
+        if name in fk_names:
+            select_related.append(lookup)
+            select_related.extend(nested_select)
+        else:
+            prefetch_related.append(lookup)
+            prefetch_related.extend(nested_select)
+        prefetch_related.extend(nested_prefetch)
+    return select_related, prefetch_related
 
 
 class Serializer(base.Serializer):
@@ -14,15 +306,37 @@ class Serializer(base.Serializer):
 
     """
 
+    # Django's base serializer has no __slots__, so instances keep a __dict__
+    # for anything else; the slots make the attributes used per object
+    # faster to read.
+    __slots__ = (
+        'options', 'stream', 'fields', 'excludes', 'relations', 'extras',
+        'use_natural_keys', 'auto_prefetch', 'use_iterator',
+        '_fields_set', '_excludes_set', '_relation_options',
+        '_relation_names', '_plan_model', '_plan', '_run_object',
+        '_extras_plan', '_n',
+    )
+
     def __init__(self, *args, **kwargs):
         """Declare instance attributes."""
         self.options = None
         self.stream = None
         self.fields = None
         self.excludes = None
+        self._fields_set = None
+        self._excludes_set = None
+        self._plan_model = None
+        self._plan = None
+        self._run_object = None
+        self._extras_plan = None
+        self._n = None
         self.relations = None
+        self._relation_options = None
+        self._relation_names = None
         self.extras = None
         self.use_natural_keys = None
+        self.auto_prefetch = None
+        self.use_iterator = None
         super(Serializer, self).__init__(*args, **kwargs)
 
     def serialize(self, queryset, **options):
@@ -33,7 +347,42 @@ class Serializer(base.Serializer):
             relations - list of related fields to be fully serialized.
             extras - list of attributes and methods to include.
                 Methods cannot take arguments.
+            auto_prefetch - if True and ``queryset`` is a QuerySet, apply the
+                select_related/prefetch_related lookups needed by
+                ``relations`` before iterating it. Querysets that already
+                use either are left alone. A list or tuple of instances of
+                one model has the same lookups prefetched in place.
+            use_iterator - if True and ``queryset`` is a QuerySet, stream it
+                with ``queryset.iterator()`` instead of filling its result
+                cache. Note that Django ignores prefetch_related lookups on
+                iterated querysets.
         """
+        self._setup(options)
+        if isinstance(queryset, QuerySet):
+            if queryset.query.is_empty():
+                # e.g. .none(); there is nothing to prefetch or iterate
+                queryset = []
+            else:
+                if self.auto_prefetch:
+                    queryset = self.prefetch_queryset(queryset)
+                if self.use_iterator:
+                    queryset = queryset.iterator()
+        elif self.auto_prefetch and isinstance(queryset, (list, tuple)):
+            self.prefetch_objects(queryset)
+        # number of objects about to be serialized, if known up front
+        if hasattr(queryset, '__len__'):
+            self._n = len(queryset)
+        else:
+            self._n = None
+
+        self.start_serialization()
+        for obj in queryset:
+            self._run_single(obj)
+        self.end_serialization()
+        return self.getvalue()
+
+    def _setup(self, options):
+        """Consume the serialization options from ``options``."""
         self.options = options
         self.stream = options.pop("stream", StringIO())
         self.fields = options.pop("fields", [])
@@ -41,61 +390,71 @@ class Serializer(base.Serializer):
         self.relations = options.pop("relations", [])
         self.extras = options.pop("extras", [])
         self.use_natural_keys = options.pop("use_natural_keys", False)
+        self.auto_prefetch = options.pop("auto_prefetch", False)
+        self.use_iterator = options.pop("use_iterator", False)
 
-        self.start_serialization()
-        for obj in queryset:
-            self.start_object(obj)
-            for field in obj._meta.local_fields:
-                attname = field.attname
-                if field.serialize:
-                    if field.rel is None:
-                        if attname not in self.excludes:
-                            if not self.fields or attname in self.fields:
-                                self.handle_field(obj, field)
-                    else:
-                        if attname[:-3] not in self.excludes:
-                            if not self.fields or attname[:-3] in self.fields:
-                                self.handle_fk_field(obj, field)
-            for field in obj._meta.many_to_many:
-                if field.serialize:
-                    if field.attname not in self.excludes:
-                        if not self.fields or field.attname in self.fields:
-                            self.handle_m2m_field(obj, field)
-            # relations patch
-            if hasattr(obj._meta, 'get_all_related_objects'):
-                related_fk_objects = obj._meta.get_all_related_objects()
-            else:
-                related_fk_objects = [
-                    f for f in obj._meta.get_fields()
-                    if (f.one_to_many or f.one_to_one) and
-                    f.auto_created and
-                    not f.concrete
-                ]
-            for ro in related_fk_objects:
-                field_name = ro.get_accessor_name()
-                if field_name not in self.excludes:
-                    self.handle_related_fk_field(obj, field_name)
-
-            if hasattr(obj._meta, 'get_all_related_many_to_many_objects'):
-                related_m2m_objects = obj._meta.get_all_related_many_to_many_objects()
-            else:
-                related_m2m_objects = [
-                    f for f in obj._meta.get_fields(include_hidden=True)
-                    if f.many_to_many and f.auto_created
-                ]
+        self._fields_set = frozenset(self.fields)
+        self._excludes_set = frozenset(self.excludes)
+        self._parse_relations()
+        self._plan_model = None
+        self._plan = None
+        self._run_object = None
 
-            for ro in related_m2m_objects:
-                field_name = ro.get_accessor_name()
-                if field_name not in self.excludes:
-                    self.handle_related_m2m_field(obj, field_name)
+    def _parse_relations(self):
+        """Precompute the per-relation options and the set of relation names
+        so handlers don't have to inspect ``relations`` for every object.
+        """
+        self._relation_options = _relation_options(self.relations)
+        self._relation_names = frozenset(self._relation_options)
 
-            # end relations patch
+    def _run_single(self, obj):
+        """Serialize a single object with the options already set up."""
+        model = type(obj)
+        if model is not self._plan_model:
+            self._plan = _build_plan(
+                model, self._fields_set, self._excludes_set)
+            self._run_object = _compile_per_object(self._plan,
+                _uses_private_handler(type(self), 'handle_field'))
+            self._extras_plan = _build_extras_plan(model, tuple(self.extras))
+            self._plan_model = model
+        self._run_object(self, obj)
 
-            for extra in self.extras:
-                self.handle_extra_field(obj, extra)
-            self.end_object(obj)
-        self.end_serialization()
-        return self.getvalue()
+    def prefetch_queryset(self, queryset):
+        """Return ``queryset`` with the lookups needed by ``relations``.
+
+        A queryset that has already been evaluated or that already uses
+        select_related or prefetch_related is returned unchanged.
+        """
+        if queryset._result_cache is not None:
+            return queryset
+        if queryset.query.select_related or queryset._prefetch_related_lookups:
+            return queryset
+        select_related, prefetch_related = _prefetch_lookups(queryset.model,
+            self._fields_set, self._excludes_set, self._relation_options)
+        if select_related:
+            queryset = queryset.select_related(*select_related)
+        if prefetch_related:
+            queryset = queryset.prefetch_related(*prefetch_related)
+        return queryset
+
+    def prefetch_objects(self, objects):
+        """Prefetch the lookups needed by ``relations`` onto a list of model
+        instances, issuing one query per relation for the whole list.
+
+        Nothing is done unless all ``objects`` are instances of one model.
+        """
+        if not objects:
+            return
+        model = type(objects[0])
+        for obj in objects:
+            if type(obj) is not model:
+                return
+        select_related, prefetch_related = _prefetch_lookups(model,
+            self._fields_set, self._excludes_set, self._relation_options)
+        # select_related can't be applied to instances, prefetch those too
+        lookups = select_related + prefetch_related
+        if lookups:
+            prefetch_related_objects(list(objects), *lookups)
 
     def handle_extra_field(self, obj, extra):
         """Called to handle 'extras' field serialization."""
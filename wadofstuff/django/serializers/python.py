@@ -6,10 +6,43 @@ by stur...@gmail.com, Apr 7, 2009.
 """
 from django.core.serializers.python import Deserializer as PythonDeserializer
 from django.db import models
-from django.utils.encoding import is_protected_type, smart_str
+from django.utils.encoding import smart_str
 
 from . import base
 
+# Types that smart_str(value, strings_only=True) returns unchanged. A tuple
+# scan is quicker than a set lookup for this few entries, and an exact type
+# check skips the isinstance() walk smart_str does.
+_PRIM = (str, int, float, bool, type(None))
+
+# sentinel for extras that are not set on an object
+_MISSING = object()
+
+# "app_label.model_name" label of each model class, as smart_str(obj._meta)
+_model_label_cache = {}
+
+
+def _iter_related(manager):
+    """
+    Iterate over the objects of the to-many related ``manager``.
+    A prefetched relation's ``all()`` comes back already evaluated and is
+    used as is; ``iterator()`` would bypass it and query again.
+    """
+    queryset = manager.all()
+    if queryset._result_cache is not None:
+        return iter(queryset._result_cache)
+    return queryset.iterator()
+
+
+def _coerce(value, _prim=_PRIM):
+    """
+    Equivalent of ``smart_str(value, strings_only=True)`` that returns the
+    common primitive values without calling it.
+    """
+    if type(value) in _prim:
+        return value
+    return smart_str(value, strings_only=True)
+
 
 class Serializer(base.Serializer):
     """
@@ -19,22 +52,31 @@ class Serializer(base.Serializer):
     ``relations`` argument.
     """
 
+    __slots__ = ('_fields', '_extras', 'objects', '_i', '_child_serializers')
+
     def __init__(self, *args, **kwargs):
         """
         Initialize instance attributes.
         """
-        self._fields = None
-        self._extras = None
+        self._fields = {}
+        self._extras = {}
         self.objects = []
+        self._i = None
+        self._child_serializers = {}
         super(Serializer, self).__init__(*args, **kwargs)
 
     def start_serialization(self):
         """
         Called when serializing of the queryset starts.
         """
-        self._fields = None
-        self._extras = None
-        self.objects = []
+        if self._n is None:
+            self.objects = []
+            self._i = None
+        else:
+            # fill a preallocated list when the object count is known
+            self.objects = [None] * self._n
+            self._i = 0
+        self._child_serializers = {}
 
     def end_serialization(self):
         """
@@ -45,54 +87,66 @@ class Serializer(base.Serializer):
     def start_object(self, obj):
         """
         Called when serializing of an object starts.
+        The same ``_fields`` and ``_extras`` dicts are reused for every
+        object; ``end_object`` stores copies of them.
         """
-        self._fields = {}
-        self._extras = {}
+        self._fields.clear()
+        self._extras.clear()
 
-    def end_object(self, obj):
+    def end_object(self, obj, _coerce=_coerce, _labels=_model_label_cache):
         """
         Called when serializing of an object ends.
         """
-        self.objects.append({
-            "model"  : smart_str(obj._meta),
-            "pk"     : smart_str(obj._get_pk_val(), strings_only=True),
-            "fields" : self._fields
-        })
+        label = _labels.get(type(obj))
+        if label is None:
+            label = _labels[type(obj)] = smart_str(obj._meta)
+        entry = {
+            "model"  : label,
+            "pk"     : _coerce(obj._get_pk_val()),
+            "fields" : self._fields.copy()
+        }
         if self._extras:
-            self.objects[-1]["extras"] = self._extras
-        self._fields = None
-        self._extras = None
+            entry["extras"] = self._extras.copy()
+        if self._i is None:
+            self.objects.append(entry)
+        else:
+            self.objects[self._i] = entry
+            self._i += 1
 
     def handle_field(self, obj, field):
         """
         Called to handle each individual (non-relational) field on an object.
         """
-        value = field._get_val_from_obj(obj)
-        # Protected types (i.e., primitives like None, numbers, dates,
-        # and Decimals) are passed through as is. All other values are
-        # converted to string first.
-        if is_protected_type(value):
-            self._fields[field.name] = value
-        else:
-            self._fields[field.name] = field.value_to_string(obj)
+        self._fields[field.name] = base._field_writer(field)(obj)
 
-    def handle_fk_field(self, obj, field):
+    def _handle_field(self, obj, field, writer):
+        """
+        ``handle_field`` with the value reader for ``field`` already looked
+        up by the serialization plan. Only used while ``handle_field`` is
+        not overridden.
+        """
+        self._fields[field.name] = writer(obj)
+
+    def handle_fk_field(self, obj, field, _coerce=_coerce):
         """
         Called to handle a ForeignKey field.
         Recursively serializes relations specified in the 'relations' option.
         """
         fname = field.name
+        if (fname not in self._relation_names and
+                field.rel.field_name == field.rel.to._meta.pk.name and
+                not (self.use_natural_keys and
+                    hasattr(field.rel.to, 'natural_key'))):
+            # only the primary key is wanted and it is already on the row,
+            # so don't fetch the related object
+            self._fields[fname] = getattr(obj, field.attname)
+            return
         related = getattr(obj, fname)
         if related is not None:
-            if fname in self.relations:
+            if fname in self._relation_names:
                 # perform full serialization of FK
-                serializer = Serializer()
-                options = {}
-                if isinstance(self.relations, dict):
-                    if isinstance(self.relations[fname], dict):
-                        options = self.relations[fname]
-                self._fields[fname] = serializer.serialize([related],
-                    **options)[0]
+                self._fields[fname] = self._nested_serialize(fname, related,
+                    single=True)
             else:
                 # emulate the original behaviour and serialize the pk value
                 if self.use_natural_keys and hasattr(related, 'natural_key'):
@@ -103,39 +157,81 @@ class Serializer(base.Serializer):
                         related = related._get_pk_val()
                     else:
                         # Related to remote object via other field
-                        related = smart_str(getattr(related,
-                            field.rel.field_name), strings_only=True)
+                        related = _coerce(getattr(related,
+                            field.rel.field_name))
                 self._fields[fname] = related
         else:
-            self._fields[fname] = smart_str(related, strings_only=True)
+            self._fields[fname] = _coerce(related)
 
-    def handle_m2m_field(self, obj, field):
+    def handle_m2m_field(self, obj, field, _coerce=_coerce):
         """
         Called to handle a ManyToManyField.
         Recursively serializes relations specified in the 'relations' option.
         """
         if field.rel.through._meta.auto_created:
             fname = field.name
-            if fname in self.relations:
+            if fname in self._relation_names:
                 # perform full serialization of M2M
-                serializer = Serializer()
-                options = {}
-                if isinstance(self.relations, dict):
-                    if isinstance(self.relations[fname], dict):
-                        options = self.relations[fname]
-                self._fields[fname] = [
-                    serializer.serialize([related], **options)[0]
-                       for related in getattr(obj, fname).iterator()]
+                self._fields[fname] = self._nested_serialize(fname,
+                    _iter_related(getattr(obj, fname)))
             else:
                 # emulate the original behaviour and serialize to a list of 
                 # primary key values
                 if self.use_natural_keys and hasattr(field.rel.to, 'natural_key'):
-                    m2m_value = lambda value: value.natural_key()
+                    self._fields[fname] = [related.natural_key()
+                        for related in _iter_related(getattr(obj, fname))]
                 else:
-                    m2m_value = lambda value: smart_str(
-                        value._get_pk_val(), strings_only=True)
-                self._fields[fname] = [m2m_value(related)
-                    for related in getattr(obj, fname).iterator()]
+                    queryset = getattr(obj, fname).all()
+                    if queryset._result_cache is not None:
+                        # prefetched
+                        self._fields[fname] = [_coerce(related._get_pk_val())
+                            for related in queryset._result_cache]
+                    else:
+                        # only the primary keys are needed, so don't build
+                        # model instances for the related rows
+                        self._fields[fname] = [_coerce(pk)
+                            for pk in queryset.values_list('pk', flat=True)]
+
+    def serialize_object(self, obj, **options):
+        """
+        Serialize a single model instance and return its entry dict, taking
+        the same options as ``serialize``. Saves wrapping ``obj`` in a list
+        and indexing the result.
+        ``end_serialization`` is not called, so subclasses such as the JSON
+        serializer write nothing to ``stream``; the entry is always returned
+        as a python dict.
+        """
+        self._setup(options)
+        if self.auto_prefetch:
+            self.prefetch_objects([obj])
+        self._n = 1
+        self.start_serialization()
+        self._run_single(obj)
+        return self.objects[0]
+
+    def _nested_serialize(self, fname, related, single=False):
+        """
+        Fully serialize ``related`` for relation ``fname`` with the options
+        given for it in ``relations``. ``related`` is a model instance if
+        ``single`` is True and the entry dict is returned, otherwise it is an
+        iterable of instances and a list of entries is returned.
+        One child serializer is set up per relation and reused for every
+        related object.
+        """
+        child = self._child_serializers.get(fname)
+        if child is None:
+            child = Serializer()
+            child._setup(dict(self._relation_options[fname]))
+            self._child_serializers[fname] = child
+        child.objects = []
+        child._i = None
+        if single:
+            child._run_single(related)
+            return child.objects[0]
+        run_single = child._run_single
+        for related_obj in related:
+            run_single(related_obj)
+        return child.objects
 
     def getvalue(self):
         """
@@ -144,17 +240,24 @@ class Serializer(base.Serializer):
         """
         return self.objects
     
-    def handle_extra_field(self, obj, field):
+    def handle_extra_field(self, obj, field, _coerce=_coerce,
+            _missing=_MISSING):
         """
         Return "extra" fields that the user specifies.
         Can be a property or callable that takes no arguments.
+        Extras the per-model extras plan knows to be defined on the model
+        class are read without probing for them first.
         """
-        if hasattr(obj, field):
+        extras_plan = self._extras_plan
+        if extras_plan and extras_plan.get(field):
             extra = getattr(obj, field)
-            if callable(extra):
-                self._extras[field] = smart_str(extra(), strings_only=True)
-            else:
-                self._extras[field] = smart_str(extra, strings_only=True)
+        else:
+            extra = getattr(obj, field, _missing)
+            if extra is _missing:
+                return
+        if callable(extra):
+            extra = extra()
+        self._extras[field] = _coerce(extra)
 
     # Reverse serialization code
 
@@ -164,16 +267,10 @@ class Serializer(base.Serializer):
         """
         fname = field_name
 
-        if field_name in self.relations:
+        if fname in self._relation_names:
             # perform full serialization of M2M
-            serializer = Serializer()
-            options = {}
-            if isinstance(self.relations, dict):
-                if isinstance(self.relations[field_name], dict):
-                    options = self.relations[field_name]
-            self._fields[fname] = [
-                serializer.serialize([related], **options)[0]
-                    for related in getattr(obj, fname).iterator()]
+            self._fields[fname] = self._nested_serialize(fname,
+                _iter_related(getattr(obj, fname)))
         else:
             pass
             # we don't really want to do this to reverse relations unless
@@ -191,21 +288,16 @@ class Serializer(base.Serializer):
         fname = field_name
         related = getattr(obj, fname)
         if related is not None:
-            if field_name in self.relations:
+            if fname in self._relation_names:
                 # perform full serialization of FK
-                serializer = Serializer()
-                options = {}
-                if isinstance(self.relations, dict):
-                    if isinstance(self.relations[field_name], dict):
-                        options = self.relations[field_name]
                 # Handle reverse foreign key lookups that recurse on the model
                 if isinstance(related, models.Manager):
                     # Related fields arrive here as querysets not modelfields
-                    self._fields[fname] = serializer.serialize(related.all(),
-                        **options)
+                    self._fields[fname] = self._nested_serialize(fname,
+                        _iter_related(related))
                 else:
-                    self._fields[fname] = serializer.serialize([related],
-                        **options)[0]
+                    self._fields[fname] = self._nested_serialize(fname,
+                        related, single=True)
             else:
                 pass
                 # we don't really want to do this to reverse relations unless
@@ -216,6 +308,6 @@ class Serializer(base.Serializer):
                 # smart_str(related._get_pk_val(), strings_only=True)
                 # for related in getattr(obj, fname).iterator()]
         else:
-            self._fields[fname] = smart_str(related, strings_only=True)
+            self._fields[fname] = _coerce(related)
 
 Deserializer = PythonDeserializer
@@ -16,6 +16,8 @@ class Serializer(PythonSerializer):
     """
     Convert a queryset to JSON.
     """
+    __slots__ = ()
+
     def end_serialization(self):
         """Output a JSON encoded queryset."""
         simplejson.dump(